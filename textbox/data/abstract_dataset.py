@@ -1,5 +1,8 @@
+import hashlib
 import os
+import numpy as np
 import torch, warnings
+from logging import getLogger
 from torch.utils.data import DataLoader, Dataset
 from textbox import CLM_MODELS
 from typing import List
@@ -16,10 +19,10 @@ class AbstractDataset(Dataset):
         if isinstance(self.quick_test, bool):
             self.quick_test = 32 if self.quick_test else 0
         self.set = set
-        source_filename = os.path.join(config["data_path"], f"{set}.src")
-        target_filename = os.path.join(config["data_path"], f"{set}.tgt")
-        self.source_text = load_data(source_filename, max_length=self.quick_test)
-        self.target_text = load_data(target_filename, max_length=self.quick_test)
+        self.source_filename = os.path.join(config["data_path"], f"{set}.src")
+        self.target_filename = os.path.join(config["data_path"], f"{set}.tgt")
+        self.source_text = load_data(self.source_filename, max_length=self.quick_test)
+        self.target_text = load_data(self.target_filename, max_length=self.quick_test)
         self.source_length = self.config["src_len"]
         self.target_length = self.config["tgt_len"]
         self.paired_text = bool(
@@ -32,15 +35,45 @@ class AbstractDataset(Dataset):
         return len(self.source_text)
 
     def __getitem__(self, idx):
+        if not self._tokenized:
+            self._tokenize()
         sample = {
             "source_text": self.source_text[idx],
-            "source_ids": self.source_ids[idx],
+            "source_ids": self._ids_at(self._source_data, self._source_offsets, idx),
             "target_text": self.target_text[idx],
         }
         if self.paired_text:
-            sample.update({"target_ids": self.target_ids[idx]})
+            sample.update({"target_ids": self._ids_at(self._target_data, self._target_offsets, idx)})
         return sample
 
+    @staticmethod
+    def _pack_ids(ids_list):
+        r"""Pack a list of id lists into one flat array plus offsets (a columnar
+        structure-of-arrays layout): sample ``i`` lives at
+        ``data[offsets[i]:offsets[i + 1]]``. One flat buffer replaces thousands
+        of small per-sample tensors and their object headers."""
+        lengths = np.fromiter((len(ids) for ids in ids_list), dtype=np.int64, count=len(ids_list))
+        offsets = np.zeros(len(ids_list) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # int32 halves the resident size; every PLM vocabulary fits comfortably
+        data = np.empty(offsets[-1], dtype=np.int32)
+        for ids, start, end in zip(ids_list, offsets[:-1], offsets[1:]):
+            data[start:end] = ids
+        return data, offsets
+
+    @staticmethod
+    def _ids_at(data, offsets, idx):
+        # embeddings index with int64, so upcast the per-sample view on access
+        return torch.from_numpy(data[offsets[idx]:offsets[idx + 1]]).long()
+
+    @property
+    def source_lengths(self) -> List[int]:
+        return np.diff(self._source_offsets).tolist()
+
+    @property
+    def target_lengths(self) -> List[int]:
+        return np.diff(self._target_offsets).tolist()
+
     def _init_process(self):
         if self.source_length > self.tokenizer.model_max_length:
             warnings.warn(
@@ -92,39 +125,110 @@ class AbstractDataset(Dataset):
         if self.config["model_name"] in ["bert2bert", "opt", "unilm", "xlm"]:
             self.target_max_length += 1
 
-    def tokenize(self, tokenizer):
+    def _cache_filename(self) -> str:
+        r"""Path of the on-disk cache of tokenized ids, keyed by everything that
+        affects the encoding (tokenizer, lengths, prompt and the raw files)."""
+        key = repr((
+            type(self.tokenizer).__name__,
+            # class and vocab size alone cannot tell two separately trained
+            # tokenizers apart; include where the tokenizer was loaded from
+            getattr(self.tokenizer, 'name_or_path', None) or self.config['tokenizer_path']
+            or self.config['model_path'],
+            len(self.tokenizer),
+            self.config["model_name"],
+            self.config["truncate"],
+            self.source_max_length,
+            self.target_max_length,
+            self.prefix_ids,
+            self.suffix_ids,
+            self.paired_text,
+            self.quick_test,
+            "soa-i32",  # storage layout version
+
+            os.path.getmtime(self.source_filename),
+            os.path.getsize(self.source_filename),
+            os.path.getmtime(self.target_filename),
+            os.path.getsize(self.target_filename),
+        ))
+        digest = hashlib.md5(key.encode()).hexdigest()[:16]
+        return os.path.join(self.config["data_path"], f"{self.set}.{digest}.cache.pt")
+
+    def _load_tokenized_cache(self, cache_file: str) -> bool:
+        if not os.path.isfile(cache_file):
+            return False
+        # the cache holds numpy arrays, which the weights_only default of
+        # torch >= 2.6 rejects; the file is self-written next to the dataset
+        try:
+            cached = torch.load(cache_file, map_location="cpu", weights_only=False)
+        except TypeError:  # torch < 1.13 has no weights_only argument
+            cached = torch.load(cache_file, map_location="cpu")
+        self._source_data, self._source_offsets = cached["source"]
+        if self.paired_text:
+            self._target_data, self._target_offsets = cached["target"]
+        getLogger(__name__).info(f"Loaded tokenized {self.set} set from {cache_file}")
+        return True
+
+    def _save_tokenized_cache(self, cache_file: str):
+        cached = {"source": (self._source_data, self._source_offsets)}
+        if self.paired_text:
+            cached["target"] = (self._target_data, self._target_offsets)
+        # write via a temporary file so concurrent processes never read a partial cache
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        torch.save(cached, tmp_file)
+        os.replace(tmp_file, cache_file)
+
+    def tokenize(self, tokenizer, lazy: bool = False):
+        r"""Bind `tokenizer` to the dataset and encode the split. With `lazy`,
+        the valid/test splits are encoded on first access instead, so a
+        training run does not pay for evaluation tokenization before the first
+        validation. Only safe without dataloader workers: a forked worker
+        hitting the lazy path would re-encode the whole split for itself."""
         self.tokenizer = tokenizer
+        self._tokenized = False
+        if self.set == "train" or not lazy:
+            self._tokenize()
+
+    def _tokenize(self):
+        tokenizer = self.tokenizer
         self._init_process()
         self._process_prompt()
-        self.source_ids = []
+        self._tokenized = True
+        cache_file = self._cache_filename() if self.config["cache_tokenized"] else None
+        if cache_file is not None and self._load_tokenized_cache(cache_file):
+            return
+        # truncate inside the (rust) tokenizer instead of slicing each encoding in Python
+        self.tokenizer.truncation_side = 'right' if self.config["truncate"] == "tail" else 'left'
         source_ids = tokenizer(
             self.source_text,
             add_special_tokens=False,
+            truncation=True,
+            max_length=self.source_max_length,
             return_token_type_ids=False,
             return_attention_mask=False,
         )["input_ids"]
-        for ids in source_ids:
-            ids = ids[:self.source_max_length] if self.config["truncate"] == "tail" else ids[-self.source_max_length:]
-            ids = self.tokenizer.build_inputs_with_special_tokens(self.prefix_ids + ids + self.suffix_ids)
-            self.source_ids.append(torch.tensor(ids, dtype=torch.long))
+        source_ids = [
+            self.tokenizer.build_inputs_with_special_tokens(self.prefix_ids + ids + self.suffix_ids)
+            for ids in source_ids
+        ]
+        self._source_data, self._source_offsets = self._pack_ids(source_ids)
         if self.paired_text:
-            self.target_ids = []
             with tokenizer.as_target_tokenizer():
                 target_ids = tokenizer(
                     self.target_text,
                     add_special_tokens=False,
+                    truncation=True,
+                    max_length=self.target_max_length,
                     return_token_type_ids=False,
                     return_attention_mask=False,
                 )["input_ids"]
-                for ids in target_ids:
-                    if self.config["truncate"] == "tail":
-                        ids = ids[:self.target_max_length]
-                    else:
-                        ids = ids[-self.target_max_length:]
-                    ids = self.tokenizer.build_inputs_with_special_tokens(ids)
-                    if self.config["model_name"] in ["bert2bert", "opt", "unilm", "xlm"]:
-                        ids = ids[1:]
-                    self.target_ids.append(torch.tensor(ids, dtype=torch.long))
+                drop_first = self.config["model_name"] in ["bert2bert", "opt", "unilm", "xlm"]
+                target_ids = [
+                    self.tokenizer.build_inputs_with_special_tokens(ids)[1 if drop_first else 0:]
+                    for ids in target_ids
+                ]
+            self._target_data, self._target_offsets = self._pack_ids(target_ids)
+        if cache_file is not None:
+            self._save_tokenized_cache(cache_file)
 
 
 class AbstractCollate:
@@ -137,46 +241,71 @@ class AbstractCollate:
         self.paired_text = bool(
             set == "train" or (self.set == 'valid' and self.config['metrics_for_best_model'] == ['loss'])
         )
+        self._arange = torch.arange(512, dtype=torch.long)
 
     @classmethod
     def get_type(cls) -> str:
         return 'pretrain disabled'
 
+    def _positions(self, max_length: int) -> torch.Tensor:
+        r"""A cached `arange` buffer, grown on demand, so building the attention
+        mask allocates no fresh position tensor per batch."""
+        if self._arange.size(0) < max_length:
+            self._arange = torch.arange(max(max_length, 2 * self._arange.size(0)), dtype=torch.long)
+        return self._arange[:max_length]
+
     def __call__(self, samples):
         batch = {}
-        source_text = []
-        source_ids = []
-        source_mask = []
-        source_length = []
-        target_text = []
+        concat_pair = self.paired_text and self.is_casual_model
         source_padding_side = ("left" if not self.paired_text and self.is_casual_model else self.tokenizer.padding_side)
 
-        for sample in samples:
-            source_text.append(sample["source_text"])
-            if self.paired_text and self.is_casual_model:
-                src_id = torch.cat([sample["source_ids"], sample["target_ids"]])
-            else:
-                src_id = sample["source_ids"]
-            source_ids.append(src_id)
-            source_mask.append(torch.ones(len(src_id), dtype=torch.long))
-            source_length.append(len(src_id))
-            target_text.append(sample["target_text"])
+        source_text = [sample["source_text"] for sample in samples]
+        target_text = [sample["target_text"] for sample in samples]
+        if concat_pair:
+            source_length = [len(sample["source_ids"]) + len(sample["target_ids"]) for sample in samples]
+        else:
+            source_length = [len(sample["source_ids"]) for sample in samples]
+        max_length = max(source_length)
+
+        # pre-allocate one destination tensor per field and fill it row by row,
+        # which avoids the per-sample cat/ones/stack round trips
+        source_ids = samples[0]["source_ids"].new_full([len(samples), max_length], self.tokenizer.pad_token_id)
+        for i, sample in enumerate(samples):
+            src_id = sample["source_ids"]
+            offset = 0 if source_padding_side == 'right' else max_length - source_length[i]
+            source_ids[i, offset:offset + len(src_id)] = src_id
+            if concat_pair:
+                source_ids[i, offset + len(src_id):offset + source_length[i]] = sample["target_ids"]
+
+        # derive the mask by broadcasting against the cached position buffer
+        length_tensor = torch.tensor(source_length, dtype=torch.long)
+        positions = self._positions(max_length)
+        if source_padding_side == 'right':
+            source_mask = (positions < length_tensor.unsqueeze(1)).long()
+        else:
+            source_mask = (positions >= (max_length - length_tensor).unsqueeze(1)).long()
 
         batch["source_text"] = source_text
-        batch["source_ids"] = _pad_sequence(source_ids, self.tokenizer.pad_token_id, source_padding_side)
-        batch["source_mask"] = _pad_sequence(source_mask, 0, source_padding_side)
-        batch["source_length"] = torch.tensor(source_length, dtype=torch.long)
+        batch["source_ids"] = source_ids
+        batch["source_mask"] = source_mask
+        batch["source_length"] = length_tensor
         batch["target_text"] = target_text
 
         if self.paired_text:
-            target_ids = []
-            for sample in samples:
-                if self.is_casual_model:
-                    tgt_id = torch.cat([
-                        torch.full([len(sample["source_ids"])], -100, dtype=torch.long), sample["target_ids"]
-                    ])
-                else:
+            if self.is_casual_model:
+                # equivalent to left-padding [-100] * len(source_ids) + target_ids to max_length
+                target_ids = torch.full([len(samples), max_length], -100, dtype=torch.long)
+                for i, sample in enumerate(samples):
+                    tgt_id = sample["target_ids"]
+                    end = source_length[i] if self.tokenizer.padding_side == 'right' else max_length
+                    target_ids[i, end - len(tgt_id):end] = tgt_id
+            else:
+                target_length = [len(sample["target_ids"]) for sample in samples]
+                max_target_length = max(target_length)
+                target_ids = torch.full([len(samples), max_target_length], -100, dtype=torch.long)
+                for i, sample in enumerate(samples):
                     tgt_id = sample["target_ids"]
-                target_ids.append(tgt_id)
-            batch["target_ids"] = _pad_sequence(target_ids, -100, self.tokenizer.padding_side)
+                    offset = 0 if self.tokenizer.padding_side == 'right' else max_target_length - len(tgt_id)
+                    target_ids[i, offset:offset + len(tgt_id)] = tgt_id
+            batch["target_ids"] = target_ids
         return batch
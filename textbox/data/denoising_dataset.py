@@ -6,7 +6,7 @@ from logging import getLogger
 from textbox import SpecialTokens
 from typing import Optional, List, Union, Dict, Tuple
 from textbox import CLM_MODELS
-from textbox.data.misc import load_data, _pad_sequence, _collate_batch
+from textbox.data.misc import load_data, _pad_sequence, _collate_batch, _fill_mask_spans
 
 
 class DenoisingCollate:
@@ -146,24 +146,11 @@ class DenoisingCollate:
         token_indices = np.argwhere(is_token == 1)
         span_starts = permutation(token_indices.shape[0])[:lengths.shape[0]]
 
-        # prepare mask
+        # prepare mask and fill up spans (JIT-compiled when numba is available)
         masked_indices = np.array(token_indices[span_starts])
         mask = np.full_like(labels, fill_value=False)
-
-        # mask span start indices
-        for mi in masked_indices:
-            mask[tuple(mi)] = True
-        lengths -= 1
-
-        # fill up spans
         max_index = labels.shape[1] - 1
-        remaining = (lengths > 0) & (masked_indices[:, 1] < max_index)
-        while np.any(remaining):
-            masked_indices[remaining, 1] += 1
-            for mi in masked_indices:
-                mask[tuple(mi)] = True
-            lengths -= 1
-            remaining = (lengths > 0) & (masked_indices[:, 1] < max_index)
+        _fill_mask_spans(mask, masked_indices, lengths, max_index)
 
         # place the mask tokens
         mask[np.where(special_tokens_mask)] = False
@@ -281,24 +268,11 @@ class TextInfillingCollate:
         token_indices = is_token.nonzero(as_tuple=False)
         span_starts = torch.randperm(token_indices.shape[0])[:lengths.shape[0]]
 
-        # prepare mask
+        # prepare mask and fill up spans (JIT-compiled when numba is available)
         masked_indices = token_indices[span_starts]
         mask = torch.full_like(inputs, fill_value=False)
-
-        # mask span start indices
-        for mi in masked_indices:
-            mask[tuple(mi)] = True
-        lengths -= 1
-
-        # fill up spans
         max_index = inputs.shape[1] - 1
-        remaining = (lengths > 0) & (masked_indices[:, 1] < max_index)
-        while torch.any(remaining):
-            masked_indices[remaining, 1] += 1
-            for mi in masked_indices:
-                mask[tuple(mi)] = True
-            lengths -= 1
-            remaining = (lengths > 0) & (masked_indices[:, 1] < max_index)
+        _fill_mask_spans(mask.numpy(), masked_indices.numpy(), lengths.long().numpy(), max_index)
 
         # place the mask tokens
         mask[special_tokens_mask] = False
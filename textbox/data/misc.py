@@ -1,7 +1,12 @@
 from typing import List, Optional
 import itertools, os
+import numpy as np
 import torch
-from torch.nn.utils.rnn import pad_sequence
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 
 def load_data(dataset_path: str, max_length: int = 0):
@@ -41,15 +46,12 @@ def _pad_sequence(tensors: List[torch.Tensor], padding_value: int, padding_side:
     Pad encoded inputs (on left/right and up to max length in the batch)
     """
     max_len = max(tensor.size(0) for tensor in tensors)
-    padded_tensors = []
-    if padding_side == 'right':
-        return pad_sequence(tensors, batch_first=True, padding_value=padding_value)
-    elif padding_side == 'left':
-        for tensor in tensors:
-            padding_length = max_len - len(tensor)
-            padded_tensor = torch.cat([torch.full([padding_length], padding_value, dtype=tensor.dtype), tensor], dim=-1)
-            padded_tensors.append(padded_tensor)
-    padded_tensors = torch.stack(padded_tensors, dim=0)
+    padded_tensors = tensors[0].new_full([len(tensors), max_len], padding_value)
+    for i, tensor in enumerate(tensors):
+        if padding_side == 'right':
+            padded_tensors[i, :tensor.size(0)] = tensor
+        else:
+            padded_tensors[i, max_len - tensor.size(0):] = tensor
     return padded_tensors
 
 
@@ -83,3 +85,29 @@ def _collate_batch(samples, tokenizer, pad_to_multiple_of: Optional[int] = None)
         else:
             result[i, -example.shape[0]:] = example
     return result
+
+
+def _fill_mask_spans_py(mask, masked_indices, lengths, max_index):
+    """Mark every masked span in `mask` (modified in place).
+
+    Each row of `masked_indices` holds the (sample, position) of a span start and
+    `lengths` the span length drawn from the poisson distribution. Spans are clipped
+    at `max_index`. All arguments are expected to be int64 numpy arrays.
+    """
+    for k in range(masked_indices.shape[0]):
+        row = masked_indices[k, 0]
+        col = masked_indices[k, 1]
+        mask[row, col] = True
+        span = lengths[k] - 1
+        while span > 0 and col < max_index:
+            col += 1
+            mask[row, col] = True
+            span -= 1
+
+
+if numba is not None:
+    _fill_mask_spans = numba.njit(cache=True)(_fill_mask_spans_py)
+    # warm the JIT cache at import time so dataloader workers pay no compile cost
+    _fill_mask_spans(np.zeros((1, 1), dtype=np.int64), np.zeros((1, 2), dtype=np.int64), np.ones(1, dtype=np.int64), 0)
+else:
+    _fill_mask_spans = _fill_mask_spans_py
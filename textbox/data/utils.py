@@ -1,3 +1,7 @@
+import os
+import random
+import numpy as np
+import torch
 from torch.utils.data import DataLoader
 from textbox.data.denoising_dataset import TextInfillingCollate, DenoisingCollate
 from ..data.unilm_dataset import UnilmCollate
@@ -12,44 +16,235 @@ collate_options = {
 }
 
 
-def data_preparation(config, tokenizer):
-    train_dataset = AbstractDataset(config, 'train')
-    valid_dataset = AbstractDataset(config, 'valid')
-    test_dataset = AbstractDataset(config, 'test')
+def get_collate(config):
+    r"""Resolve the collate class for `config` once, instead of re-deriving it
+    per dataloader. The unilm model always uses its own collate."""
+    if config['model_name'] == 'unilm':
+        return UnilmCollate
+    return collate_options.get(config['pretrain_task'], AbstractCollate)
 
-    train_dataset.tokenize(tokenizer)
-    valid_dataset.tokenize(tokenizer)
-    test_dataset.tokenize(tokenizer)
 
-    collate_name = config['pretrain_task']
-    if config['model_name'] == 'unilm':
-        collate_name = 'unilm'
-    collate_fn = collate_options.get(collate_name, AbstractCollate)
+def _seed_worker(worker_id):
+    r"""Reseed numpy and random in each dataloader worker. torch gives every
+    worker a distinct seed but only applies it to its own generator; forked
+    workers inherit the parent's numpy state, so without this the denoising
+    collates would draw the same poisson/permutation stream in every worker."""
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+class LengthGroupedBatchSampler:
+    r"""Yield shuffled batches of indices grouped by sequence length: indices
+    are shuffled, chunked into mega-batches of `mega_batch_mult * batch_size`,
+    sorted by length within each mega-batch and then cut into batches. Similar
+    lengths end up in the same batch, cutting the padding the collate fns have
+    to add, while batch composition still changes every epoch."""
+
+    def __init__(self, lengths, batch_size, mega_batch_mult=50):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.mega_batch_mult = mega_batch_mult
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        indices = torch.randperm(len(self.lengths)).tolist()
+        mega_batch_size = self.mega_batch_mult * self.batch_size
+        for i in range(0, len(indices), mega_batch_size):
+            mega_batch = sorted(indices[i:i + mega_batch_size], key=self.lengths.__getitem__, reverse=True)
+            for j in range(0, len(mega_batch), self.batch_size):
+                yield mega_batch[j:j + self.batch_size]
+
+
+class CUDAPrefetcher:
+    r"""Iterate a dataloader one batch ahead, copying the next batch to `device`
+    on a side CUDA stream so the host-to-device transfer overlaps with the
+    compute on the current batch. `len()` and `dataset` mirror the wrapped
+    dataloader, so the wrapper is a drop-in replacement in the trainer."""
+
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.device = device
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    @property
+    def dataset(self):
+        return self.dataloader.dataset
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device)
+        batch = None
+        for next_batch in self.dataloader:
+            with torch.cuda.stream(stream):
+                for key, value in next_batch.items():
+                    if isinstance(value, torch.Tensor):
+                        # non_blocking copies only overlap when the source is
+                        # page-locked; pin here if the loader did not already
+                        if not value.is_cuda and not value.is_pinned():
+                            value = value.pin_memory()
+                        next_batch[key] = value.to(self.device, non_blocking=True)
+            if batch is not None:
+                yield batch
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            for value in next_batch.values():
+                if isinstance(value, torch.Tensor) and value.is_cuda:
+                    value.record_stream(torch.cuda.current_stream(self.device))
+            batch = next_batch
+        if batch is not None:
+            yield batch
+
+
+class _CudaCollate:
+    r"""Move the collated tensors to `device` inside the collate_fn, so batches
+    arrive on GPU before `accelerator.prepare` sees them. Only usable without
+    dataloader workers: CUDA tensors cannot be created in forked processes."""
+
+    def __init__(self, collate_fn, device):
+        self.collate_fn = collate_fn
+        self.device = device
+
+    def __call__(self, samples):
+        batch = self.collate_fn(samples)
+        for key, value in batch.items():
+            if isinstance(value, torch.Tensor):
+                batch[key] = value.to(self.device, non_blocking=True)
+        return batch
+
+
+class _TensorFieldLoader:
+    r"""View of a dataloader that keeps only the tensor fields of each batch,
+    the subset a tensor socket can transport. The text-list fields are dropped
+    on the producer's local path too, so all sharing processes train on
+    identical batches (models whose forward reads `source_text` cannot be
+    shared this way)."""
+
+    def __init__(self, dataloader):
+        self.dataloader = dataloader
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        for batch in self.dataloader:
+            yield {key: value for key, value in batch.items() if isinstance(value, torch.Tensor)}
+
+
+class _SharedDataLoader:
+    r"""Present a TensorProducer/TensorConsumer as a train dataloader. The
+    producer knows the epoch length from the local loader it serves; the
+    consumer has no local dataset, so `len()` raises TypeError and the
+    trainer falls back to a length-less epoch."""
+
+    def __init__(self, shared, length=None):
+        self.shared = shared
+        self.length = length
+
+    def __len__(self):
+        if self.length is None:
+            raise TypeError('the length of a consumer-side shared dataloader is unknown')
+        return self.length
+
+    def __iter__(self):
+        return iter(self.shared)
+
+
+def _share_train_dataloader(config, train_dataloader):
+    r"""Share one training data loader across collocated training processes via
+    TensorSocket: the producer process iterates the real loader and serves the
+    collated tensor fields over a socket, while consumer processes receive them
+    without running data loading or collation at all."""
+    try:
+        import tensorsocket
+    except ImportError:
+        raise ImportError(
+            'tensorsocket is required to share data loaders across processes '
+            '(`pip install tensorsocket`), or unset the `tensorsocket` option.'
+        )
+    role = config['tensorsocket']
+    port = config['tensorsocket_port'] or 5555
+    ack_port = config['tensorsocket_ack_port'] or port + 1
+    if role == 'producer':
+        producer = tensorsocket.TensorProducer(_TensorFieldLoader(train_dataloader), port=port, ack_port=ack_port)
+        return _SharedDataLoader(producer, length=len(train_dataloader))
+    elif role == 'consumer':
+        return _SharedDataLoader(tensorsocket.TensorConsumer(port=port, ack_port=ack_port))
+    raise ValueError(f"tensorsocket should be 'producer' or 'consumer', got '{role}'.")
+
+
+def data_preparation(config, tokenizer):
+    collate_fn = get_collate(config)
     logger = getLogger(__name__)
     logger.info(f'Pretrain type: {collate_fn.get_type()}')
 
     if config['dataset'] == 'multiwoz':
         assert config['eval_batch_size'] % 3 == 0
 
-    train_dataloader = DataLoader(
-        train_dataset,
-        batch_size=config['train_batch_size'],
-        shuffle=True,
-        pin_memory=True,
-        collate_fn=collate_fn(config, tokenizer, 'train')
-    )
-    valid_dataloader = DataLoader(
-        valid_dataset,
-        batch_size=config['eval_batch_size'],
-        shuffle=False,
-        pin_memory=True,
-        collate_fn=collate_fn(config, tokenizer, 'valid')
-    )
-    test_dataloader = DataLoader(
-        test_dataset,
-        batch_size=config['eval_batch_size'],
-        shuffle=False,
-        pin_memory=True,
-        collate_fn=collate_fn(config, tokenizer, 'test')
-    )
+    num_workers = config['num_workers']
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count() or 1)
+    # pinning pages is only useful (and only cheap) when a H2D copy follows;
+    # it can be forced off (pin_memory: False) where the pin thread costs more
+    # than the copy saves -- worth measuring per machine
+    pin_memory = config['pin_memory']
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    loader_kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory}
+    if num_workers > 0:
+        # keep workers alive between epochs so collation overlaps with compute
+        loader_kwargs['persistent_workers'] = True
+        loader_kwargs['prefetch_factor'] = config['prefetch_factor'] or 4
+        loader_kwargs['worker_init_fn'] = _seed_worker
+        if 'fork' in torch.multiprocessing.get_all_start_methods():
+            # fork shares the tokenizer held by collate_fn copy-on-write
+            loader_kwargs['multiprocessing_context'] = 'fork'
+
+    collate_to_cuda = num_workers == 0 and getattr(config['device'], 'type', None) == 'cuda'
+    if collate_to_cuda:
+        # batches already leave the collate_fn on GPU, nothing is left to pin
+        loader_kwargs['pin_memory'] = False
+
+    def build_dataloader(set, batch_size, shuffle):
+        dataset = AbstractDataset(config, set)
+        # with workers, encode in this process before they fork; deferring to
+        # __getitem__ would make every (persistent) worker encode the split
+        dataset.tokenize(tokenizer, lazy=num_workers == 0)
+        collate = collate_fn(config, tokenizer, set)
+        if collate_to_cuda:
+            collate = _CudaCollate(collate, config['device'])
+        if shuffle and config['length_bucket']:
+            # evaluation splits keep their original order (the evaluators rely
+            # on it), but training batches can be grouped by length
+            lengths = dataset.source_lengths
+            if dataset.paired_text:
+                lengths = [l + t for l, t in zip(lengths, dataset.target_lengths)]
+            batch_sampler = LengthGroupedBatchSampler(lengths, batch_size)
+            return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate, **loader_kwargs)
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate, **loader_kwargs)
+
+    # skip the splits disabled by the configuration entirely; evaluation-only
+    # runs (do_train=False) need neither the train nor the valid loader
+    if not config['do_train']:
+        train_dataloader = None
+    elif config['tensorsocket'] == 'consumer':
+        # consumers get fully collated batches over the socket; building and
+        # tokenizing the train split here would duplicate the producer's work
+        train_dataloader = _share_train_dataloader(config, None)
+    else:
+        train_dataloader = build_dataloader('train', config['train_batch_size'], shuffle=True)
+        if config['tensorsocket']:
+            train_dataloader = _share_train_dataloader(config, train_dataloader)
+    valid_dataloader = build_dataloader('valid', config['eval_batch_size'], shuffle=False) \
+        if config['do_train'] and config['do_valid'] else None
+    test_dataloader = build_dataloader('test', config['eval_batch_size'], shuffle=False) \
+        if config['do_test'] else None
+
+    if num_workers > 0:
+        # fast tokenizers deadlock when their thread pool is alive across a fork;
+        # batch encoding is done in this process, so disable parallelism before
+        # the dataloader workers are forked at first iteration
+        os.environ['TOKENIZERS_PARALLELISM'] = 'false'
     return train_dataloader, valid_dataloader, test_dataloader
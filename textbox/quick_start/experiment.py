@@ -4,11 +4,12 @@ from copy import copy
 from logging import getLogger
 from typing import Optional, Tuple, Any, List, Dict
 
+import torch
 from accelerate import Accelerator
 from torch.utils.data import DataLoader
 
 from ..config.configurator import Config
-from ..data.utils import data_preparation
+from ..data.utils import data_preparation, CUDAPrefetcher
 from ..trainer.trainer import Trainer
 from ..utils.dashboard import SummaryTracker
 from ..utils.logger import init_logger
@@ -16,6 +17,13 @@ from ..utils.utils import get_model, get_tokenizer, get_trainer, init_seed
 
 ResultType = Dict[str, Any]
 
+# extended-config keys baked into the prepared dataloaders at startup; a run()
+# that changes one of them needs the loaders rebuilt
+_DATALOADER_PARAMETERS = frozenset((
+    'train_batch_size', 'eval_batch_size', 'num_workers', 'prefetch_factor', 'pin_memory',
+    'length_bucket', 'cuda_prefetch', 'tensorsocket', 'tensorsocket_port', 'tensorsocket_ack_port'
+))
+
 
 class Experiment:
     r""" A fast running api, which includes the complete process of
@@ -37,8 +45,12 @@ class Experiment:
     ):
         self.config = Config(model, dataset, config_file_list, config_dict)
         self.__extended_config = None
+        self.__config_snapshot = None
+        self.__loaders_extended = False
 
-        self.accelerator = Accelerator()
+        # 'fp16'/'bf16' runs forwards under autocast with loss scaling handled
+        # by accelerate; None defers to the accelerate launcher configuration
+        self.accelerator = Accelerator(mixed_precision=self.config['mixed_precision'])
         self.config.update({'_is_local_main_process': self.accelerator.is_local_main_process})
         self.logger = self.init_logger(self.config)
         self.summary_tracker = SummaryTracker.basicConfig(self.get_config())
@@ -46,10 +58,16 @@ class Experiment:
             self._init_data(self.get_config(), self.accelerator)
 
     def get_config(self) -> Config:
-        config = copy(self.config)
         if self.__extended_config is not None:
+            config = copy(self.config)
+            # give the extended config its own dict so extensions of one run
+            # cannot leak into the base configuration of the next
+            config.final_config_dict = copy(config.final_config_dict)
             config.update(self.__extended_config)
-        return config
+            return config
+        if self.__config_snapshot is None:
+            self.__config_snapshot = copy(self.config)
+        return self.__config_snapshot
 
     @staticmethod
     def init_logger(config: Config) -> logging.Logger:
@@ -69,8 +87,25 @@ class Experiment:
     @staticmethod
     def _init_data(config: Config, accelerator: Accelerator) -> Tuple[DataLoader, DataLoader, DataLoader, Any]:
         tokenizer = get_tokenizer(config)
-        train_data, valid_data, test_data = data_preparation(config, tokenizer)
-        train_data, valid_data, test_data = accelerator.prepare(train_data, valid_data, test_data)
+        dataloaders = list(data_preparation(config, tokenizer))
+        prefetch = config['cuda_prefetch'] and torch.cuda.is_available()
+        for i, dataloader in enumerate(dataloaders):
+            if dataloader is None:  # the split is disabled by the configuration
+                continue
+            if not isinstance(dataloader, DataLoader):
+                # tensorsocket producers/consumers transport batches themselves;
+                # neither accelerate's preparation nor the prefetcher applies
+                continue
+            if prefetch:
+                # keep accelerate's device placement off so batches reach the
+                # prefetcher on CPU and the H2D copy runs on its side stream;
+                # with placement on, the copy would already have happened
+                # synchronously inside the prepared loader
+                dataloader = accelerator.prepare_data_loader(dataloader, device_placement=False)
+                dataloaders[i] = CUDAPrefetcher(dataloader, accelerator.device)
+            else:
+                dataloaders[i] = accelerator.prepare(dataloader)
+        train_data, valid_data, test_data = dataloaders
         return train_data, valid_data, test_data, tokenizer
 
     def _on_experiment_start(self, extended_config: Optional[dict]):
@@ -81,6 +116,17 @@ class Experiment:
         config = self.get_config()
         init_seed(config['seed'], config['reproducibility'])
 
+        # rebuild also when the previous run() extended one of these keys, so
+        # its loaders do not leak into a trial that runs with the defaults
+        loaders_extended = bool(extended_config) and not _DATALOADER_PARAMETERS.isdisjoint(extended_config)
+        if loaders_extended or self.__loaders_extended:
+            self.logger.info('Rebuilding dataloaders: {} changed.'.format(
+                sorted(_DATALOADER_PARAMETERS.intersection(extended_config or ())) or 'loader parameters reset'
+            ))
+            self.train_data, self.valid_data, self.test_data, self.tokenizer = \
+                self._init_data(config, self.accelerator)
+        self.__loaders_extended = loaders_extended
+
         self.model = get_model(config['model'])(config, self.tokenizer).to(config['device'])
         self.logger.info(self.model)
         self.trainer: Trainer = get_trainer(config['model'])(config, self.model, self.accelerator)
@@ -100,11 +146,14 @@ class Experiment:
             if self.config['load_experiment'] is not None:
                 self.trainer.resume_checkpoint(resume_file=self.config['load_experiment'])
             train_data = self.train_data
-            valid_data = self.valid_data if self.do_valid else None
+            valid_data = self.valid_data if self.do_valid and self.valid_data is not None else None
 
             self.valid_result = self.trainer.fit(train_data, valid_data)
 
     def _do_test(self):
+        if self.do_test and self.test_data is None:
+            self.logger.warning('Test skipped: the test dataloader was not built (do_test was off at startup).')
+            return
         if self.do_test:
             with self.summary_tracker.new_epoch('eval'):
                 self.test_result = self.trainer.evaluate(self.test_data, model_file=self.config['load_experiment'])
@@ -122,6 +171,10 @@ class Experiment:
             from ..utils import safe_remove
             safe_remove(saved_filename)
             safe_remove(saved_link)
+        # the Accelerator is shared across run() invocations (hyper-tuning and
+        # multi-seed sweeps); release the model/optimizer it registered during
+        # this run so repeated trials do not accumulate them on the GPU
+        self.accelerator.free_memory()
         self.__extended_config = None
 
     def run(self, extended_config: Optional[dict] = None):
@@ -1,5 +1,6 @@
-import collections
 import os
+import threading
+from contextlib import nullcontext
 from logging import getLogger
 from typing import Optional, Union, List, Dict
 import math
@@ -20,7 +21,34 @@ from .scheduler import (
 from torch.utils.data import DataLoader
 from ..evaluator import BaseEvaluator
 from ..model.abstract_model import AbstractModel
-from ..utils import serialized_save, init_seed
+from ..utils import serialized_save, init_seed, load_checkpoint
+
+
+def _detach_to_cpu(obj):
+    r"""Recursively detach tensors to CPU copies, so a checkpoint snapshot stays
+    valid while training keeps mutating the live parameters."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu() if obj.is_cuda else obj.detach().clone()
+    if isinstance(obj, dict):
+        return {key: _detach_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_detach_to_cpu(value) for value in obj]
+    if isinstance(obj, tuple):
+        # e.g. AbstractScheduler.state_dict() returns (optimizer_state, n_steps)
+        return tuple(_detach_to_cpu(value) for value in obj)
+    return obj
+
+
+def _strip_paraphrase_source(gen: str) -> str:
+    r"""Keep only the paraphrase part of a generated sequence: the segment
+    between the first two ``[SEP]`` tokens, or, lacking a separator, the text
+    after the last parenthesized annotation."""
+    _, sep, after = gen.partition('[SEP]')
+    if sep:
+        return after.partition('[SEP]')[0].strip()
+    last = max(gen.rfind('('), gen.rfind(')'))
+    last = gen.find(' ', last)
+    return gen[last:].strip()
 
 
 class AbstractTrainer:
@@ -78,7 +106,8 @@ class Trainer(AbstractTrainer):
         self.adafactor_kwargs = config['adafactor_kwargs']
         self.scheduler_kwargs = config['scheduler_kwargs']
         self.grad_clip = config['grad_clip']
-        self._trainable_parameters = filter(lambda x: x.requires_grad, self.model.parameters())
+        # materialize once: a filter generator could only be consumed a single time
+        self._trainable_parameters = [p for p in self.model.parameters() if p.requires_grad]
         self.optimizer = self._build_optimizer(config['optimizer'], config['scheduler'])
         self.accumulation_steps = config['accumulation_steps']
 
@@ -116,6 +145,8 @@ class Trainer(AbstractTrainer):
             self.max_save = 1
         self.disable_tqdm = config['disable_tqdm'] or not self.accelerator.is_local_main_process
         self._summary_tracker = get_dashboard()
+        self._save_thread: Optional[threading.Thread] = None
+        self._model_prepared = False
 
     def _build_optimizer(self, optimizer: str, scheduler: Optional[str])\
             -> Union[optim.Optimizer, AbstractScheduler]:
@@ -125,16 +156,14 @@ class Trainer(AbstractTrainer):
             Union[optim.Optimizer, AbstractScheduler]: the optimizer
         """
 
-        optimizer_class = collections.defaultdict(
-            lambda: optim.AdamW, {
-                'adam': optim.Adam,
-                'adamw': optim.AdamW,
-                'sgd': optim.SGD,
-                'adagrad': optim.Adagrad,
-                'rmsprop': optim.RMSprop,
-                'adafactor': transformers.Adafactor,
-            }
-        )
+        optimizer_class = {
+            'adam': optim.Adam,
+            'adamw': optim.AdamW,
+            'sgd': optim.SGD,
+            'adagrad': optim.Adagrad,
+            'rmsprop': optim.RMSprop,
+            'adafactor': transformers.Adafactor,
+        }
         scheduler_class = {
             'inverse': InverseSquareRootScheduler,
             'cosine': CosineScheduler,
@@ -153,9 +182,25 @@ class Trainer(AbstractTrainer):
                 )
             self.optimizer_kwargs.update(self.adafactor_kwargs)
 
+        # prefer the fused CUDA kernel over the default per-tensor loop, unless
+        # the user already chose an implementation via optimizer_kwargs
+        if torch.cuda.is_available() and optimizer in ('adam', 'adamw', 'sgd') \
+                and 'fused' not in self.optimizer_kwargs and 'foreach' not in self.optimizer_kwargs:
+            self.optimizer_kwargs['fused'] = True
+
         # get optimizer (use default value of pytorch if self.optimizer_kwargs is empty)
         self.logger.debug(f'Using optimizer {optimizer}')
-        optimizer = optimizer_class[optimizer](params=self._trainable_parameters, **self.optimizer_kwargs)
+        try:
+            optimizer = optimizer_class.get(optimizer, optim.AdamW)(
+                params=self._trainable_parameters, **self.optimizer_kwargs
+            )
+        except (TypeError, RuntimeError):
+            # this torch build does not provide the fused implementation
+            if self.optimizer_kwargs.pop('fused', None) is None:
+                raise
+            optimizer = optimizer_class.get(optimizer, optim.AdamW)(
+                params=self._trainable_parameters, **self.optimizer_kwargs
+            )
 
         # scheduling
         if scheduler is not None and scheduler in scheduler_class:
@@ -201,10 +246,22 @@ class Trainer(AbstractTrainer):
             dict: Training losses.
         """
         self.model.train()
+        # len() on a prepared dataloader is not free, keep it out of the loop
+        try:
+            num_batches = len(train_data)
+        except TypeError:  # a tensorsocket consumer does not know its length
+            num_batches = None
+        # parameters() walks the module tree on every call; snapshot the list
+        # once per epoch for gradient clipping
+        clip_parameters = list(self.model.parameters()) if self.grad_clip is not None else None
+        # bind the two bound methods hit on every boundary step to locals,
+        # skipping the attribute lookups inside the loop
+        optimizer_step = self.optimizer.step
+        optimizer_zero_grad = self.optimizer.zero_grad
         if not self.disable_tqdm:
-            train_data_len = math.ceil(len(train_data) / self.accumulation_steps)
+            train_data_len = math.ceil(num_batches / self.accumulation_steps) if num_batches is not None else None
             train_tqdm = tqdm(
-                range(train_data_len),
+                total=train_data_len,
                 desc=f"train {epoch_idx:4}",
                 dynamic_ncols=True,
                 postfix={'loss': None},
@@ -212,6 +269,7 @@ class Trainer(AbstractTrainer):
             )
 
         with self._summary_tracker.new_epoch('train'):
+            pending_losses = []
             for step, data in enumerate(train_data):
                 if step % self.accumulation_steps == 0:
                     self._summary_tracker.new_step()
@@ -219,29 +277,56 @@ class Trainer(AbstractTrainer):
                         self.stopped = True
                         break
 
-                loss = self.model(data, epoch_idx=epoch_idx)
-                # loss = self.accelerator.gather(loss).mean().item()
-                self._summary_tracker.append_loss(loss.item())
-                self.accelerator.backward(loss / self.accumulation_steps)
-
-                if (step + 1) % self.accumulation_steps == 0 or (step + 1) == len(train_data):
+                is_boundary = (step + 1) % self.accumulation_steps == 0 or (step + 1) == num_batches
+                # gradients only need to be synchronized across processes on
+                # the micro-step that actually runs the optimizer
+                sync_context = nullcontext() if is_boundary else self.accelerator.no_sync(self.model)
+                with sync_context:
+                    loss = self.model(data, epoch_idx=epoch_idx)
+                    # defer the GPU->CPU read of the loss to the boundary step,
+                    # so micro-steps do not stall the CUDA pipeline on .item()
+                    pending_losses.append(loss.detach())
+                    self.accelerator.backward(loss / self.accumulation_steps)
+
+                if is_boundary:
+                    for pending_loss in torch.stack(pending_losses).tolist():
+                        self._summary_tracker.append_loss(pending_loss)
+                    pending_losses.clear()
                     if self.grad_clip is not None:
-                        self.accelerator.clip_grad_norm_(self.model.parameters(), self.grad_clip)
-                    self.optimizer.step()
-                    self.optimizer.zero_grad()
+                        self.accelerator.clip_grad_norm_(clip_parameters, self.grad_clip)
+                    optimizer_step()
+                    # set_to_none frees the gradient tensors instead of filling
+                    # them with zeros, saving a memset per parameter
+                    optimizer_zero_grad(set_to_none=True)
                     if not self.disable_tqdm:
                         train_tqdm.update(1)
-                        train_tqdm.set_postfix(loss=self._summary_tracker.epoch_loss())
+                        # epoch_loss() reduces the whole epoch tracker; refresh
+                        # the postfix every few steps rather than every step
+                        if train_tqdm.n % 10 == 0 or train_tqdm.n == train_data_len:
+                            train_tqdm.set_postfix(loss=self._summary_tracker.epoch_loss())
                     if valid_data:
                         self.stopped |= self._valid(valid_data, 'step')
                     if self.stopped:
                         break
 
+            if pending_losses and not self.stopped:
+                # a length-less loader can end mid-accumulation window; run the
+                # boundary work for the leftover micro-steps
+                for pending_loss in torch.stack(pending_losses).tolist():
+                    self._summary_tracker.append_loss(pending_loss)
+                pending_losses.clear()
+                if self.grad_clip is not None:
+                    self.accelerator.clip_grad_norm_(clip_parameters, self.grad_clip)
+                optimizer_step()
+                optimizer_zero_grad(set_to_none=True)
+                if not self.disable_tqdm:
+                    train_tqdm.update(1)
+
             if not self.disable_tqdm:
                 train_tqdm.close()
             return self._summary_tracker.epoch_dict()
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def _valid(
         self,
         valid_data: DataLoader,
@@ -282,17 +367,17 @@ class Trainer(AbstractTrainer):
                 else:
                     valid_tqdm = valid_data
 
-                losses = 0
+                losses = []
                 for data in valid_tqdm:
                     self._summary_tracker.new_step()
-                    loss = self.model(data)
-                    loss = self.accelerator.gather(loss)
-                    loss = loss.mean().item()
-                    losses += loss
-                    self._summary_tracker.append_loss(loss)
-                    if not self.disable_tqdm:
-                        valid_tqdm.set_postfix(loss=self._summary_tracker.epoch_loss())
-                valid_results = {'loss': losses / len(valid_tqdm)}
+                    losses.append(self.model(data).detach())
+                # one gather and one readback for the whole pass, instead of a
+                # cross-process reduction plus .item() sync per batch
+                loss = self.accelerator.gather(torch.stack(losses)).mean().item()
+                self._summary_tracker.append_loss(loss)
+                if not self.disable_tqdm:
+                    valid_tqdm.set_postfix(loss=loss)
+                valid_results = {'loss': loss}
             else:
                 valid_results = self.evaluate(valid_data, is_valid=True)
             self._summary_tracker.set_metrics_results(valid_results)
@@ -334,14 +419,15 @@ class Trainer(AbstractTrainer):
             self.logger.warning('Get checkpoint failed. No validation has been performed.')
             return None
 
-        # construct state_dict and parameters
-        _state_dict = self.accelerator.unwrap_model(self.model).state_dict()
+        # construct state_dict and parameters; snapshot to CPU so serialization
+        # can proceed in the background while training continues
+        _state_dict = _detach_to_cpu(self.accelerator.unwrap_model(self.model).state_dict())
 
         # get optimizer, config and validation summary
         checkpoint = {
             # parameters that needed to be loaded
             'state_dict': _state_dict,
-            'optimizer': self.optimizer.state_dict(),
+            'optimizer': _detach_to_cpu(self.optimizer.state_dict()),
             'stopping_count': self.stopping_count,
             'best_valid_score': self._summary_tracker.best_valid_score,
             'epoch': self.timestamp.train_epoch,
@@ -353,19 +439,37 @@ class Trainer(AbstractTrainer):
         self.logger.debug(checkpoint)
         return checkpoint
 
+    def _wait_for_checkpoint(self):
+        r"""Block until the checkpoint being written in the background (if any)
+        has reached the disk."""
+        if self._save_thread is not None:
+            self._save_thread.join()
+            self._save_thread = None
+
     def save_checkpoint(self):
         serial_idx = self.timestamp.valid_epoch
         serial_of_soft_link = self.best_valid_timestamp.valid_epoch
 
-        serialized_save(
-            self._get_checkpoint(),
-            serial=serial_idx,
-            serial_of_soft_link=serial_of_soft_link,
-            path_without_extension=self.saved_model_filename,
-            tag='epoch',
-            extension_name='pth',
-            max_save=self.max_save,
+        # mirror the max_save policy of serialized_save: if this epoch's file
+        # would not be written anyway, skip the CPU snapshot of the state dict
+        if self.max_save == 0 or (self.max_save == 1 and serial_of_soft_link != serial_idx):
+            return
+
+        checkpoint = self._get_checkpoint()
+        self._wait_for_checkpoint()  # one writer at a time
+        self._save_thread = threading.Thread(
+            target=serialized_save,
+            args=(checkpoint,),
+            kwargs=dict(
+                serial=serial_idx,
+                serial_of_soft_link=serial_of_soft_link,
+                path_without_extension=self.saved_model_filename,
+                tag='epoch',
+                extension_name='pth',
+                max_save=self.max_save,
+            ),
         )
+        self._save_thread.start()
 
     def save_generated_text(self, generated_corpus: List[str], is_valid: bool = False):
         r"""Store the generated text by our model into `self.saved_text_filename`."""
@@ -391,7 +495,7 @@ class Trainer(AbstractTrainer):
         # check
         self.logger.info("Resuming checkpoint from {}...".format(resume_file))
         if os.path.isfile(resume_file):
-            checkpoint = torch.load(resume_file, map_location=self.device)
+            checkpoint = load_checkpoint(resume_file)
         else:
             self.logger.warning('Checkpoint file "{}" not found. Resuming stopped.'.format(resume_file))
             return
@@ -439,7 +543,16 @@ class Trainer(AbstractTrainer):
              dict: the best valid score and best valid result.
         """
 
-        self.model, self.optimizer = self.accelerator.prepare(self.model, self.optimizer)
+        if isinstance(self.optimizer, AbstractScheduler):
+            # accelerate does not recognize the scheduler wrapper as an
+            # optimizer and would pass it through unregistered, leaving fp16
+            # loss scaling without the matching unscale/step handling;
+            # prepare the wrapped optimizer and keep the scheduler on top
+            self.model = self.accelerator.prepare(self.model)
+            self.optimizer.optimizer = self.accelerator.prepare(self.optimizer.optimizer)
+        else:
+            self.model, self.optimizer = self.accelerator.prepare(self.model, self.optimizer)
+        self._model_prepared = True
 
         self.logger.info("====== Start training ======")
         self.accelerator.wait_for_everyone()
@@ -459,6 +572,7 @@ class Trainer(AbstractTrainer):
                     self.logger.info(f'Stopped at max_steps {self.max_steps}.')
                 break
 
+        self._wait_for_checkpoint()
         file = self.saved_model_filename + ".pth"
         if os.path.exists(file):
             self.logger.info(f'Soft link created: {file} -> {os.readlink(file)}')
@@ -471,7 +585,7 @@ class Trainer(AbstractTrainer):
         self.logger.info('Best valid result: {}'.format(self.best_valid_result.as_str()))
         return self.best_valid_result.as_dict()
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def evaluate(
         self,
         eval_data: DataLoader,
@@ -496,6 +610,7 @@ class Trainer(AbstractTrainer):
             load_best_model = False
 
         if load_best_model:
+            self._wait_for_checkpoint()
             checkpoint_file = model_file or self.saved_model_filename + '.pth'
             if not os.path.isfile(checkpoint_file):
                 self.logger.error(
@@ -504,21 +619,30 @@ class Trainer(AbstractTrainer):
                 )
                 return None
             self.logger.info('Loading model structure and parameters from {} ...'.format(checkpoint_file))
-            checkpoint = torch.load(checkpoint_file, map_location=self.device)
+            checkpoint = load_checkpoint(checkpoint_file)
             self.model.load_state_dict(checkpoint['state_dict'])
             self.accelerator.wait_for_everyone()
             del checkpoint
 
-        if not is_valid:
+        # a model that already went through prepare() in fit() lives on the
+        # right device; preparing it again only re-registers it with accelerate
+        if not is_valid and not self._model_prepared:
             self.model = self.accelerator.prepare(self.model)
+            self._model_prepared = True
 
         self.model.eval()
 
         if self.config['dataset'] == 'multiwoz':
             self.evaluator.evaluators[0].load_data('valid' if is_valid else 'test')
             turn_domains = self.evaluator.evaluators[0].turn_domains
+            # every-third-row masks only depend on the batch size; build them
+            # on device once and reuse across batches
+            idx_mask_cache = {}
+            db_nores_id = self.model.tokenizer.convert_tokens_to_ids('[db_nores]')
 
         # generate
+        corpus_len = len(eval_data.dataset.target_text)
+        reference_dataset = eval_data.dataset
         generate_corpus = []
         eval_tqdm = tqdm(eval_data, desc="generating", dynamic_ncols=True) if not self.disable_tqdm else eval_data
         for i, batch_data in enumerate(eval_tqdm):
@@ -526,14 +650,17 @@ class Trainer(AbstractTrainer):
                 generated = self.accelerator.unwrap_model(self.model).generate(batch_data, self.accelerator)
             else:
                 batch_size = batch_data['source_ids'].size(0)
-                idx_mask = torch.zeros(batch_size).to(self.device).bool()
-                idx_mask[::3] = 1
+                if batch_size not in idx_mask_cache:
+                    idx_mask = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
+                    idx_mask[::3] = True
+                    idx_mask_cache[batch_size] = (idx_mask, ~idx_mask)
+                idx_mask, asrs_mask = idx_mask_cache[batch_size]
                 bs_batch = {}
                 bs_batch['source_ids'] = batch_data['source_ids'][idx_mask]
                 bs_batch['source_mask'] = batch_data['source_mask'][idx_mask]
                 asrs_batch = {}
-                asrs_batch['source_ids'] = batch_data['source_ids'][~idx_mask]
-                asrs_batch['source_mask'] = batch_data['source_mask'][~idx_mask]
+                asrs_batch['source_ids'] = batch_data['source_ids'][asrs_mask]
+                asrs_batch['source_mask'] = batch_data['source_mask'][asrs_mask]
                 bs_outputs = self.accelerator.unwrap_model(self.model).generate(bs_batch, self.accelerator)
 
                 batch_size //= 3
@@ -543,27 +670,21 @@ class Trainer(AbstractTrainer):
                 ]
                 db_ids = torch.tensor(self.model.tokenizer.convert_tokens_to_ids(db_texts)).long()
                 db_ids = db_ids.repeat_interleave(2).to(self.device)
-                db_idx = torch.eq(asrs_batch['source_ids'], self.model.tokenizer.convert_tokens_to_ids('[db_nores]'))
+                db_idx = torch.eq(asrs_batch['source_ids'], db_nores_id)
                 asrs_batch['source_ids'][db_idx] = db_ids
                 asrs_outputs = self.accelerator.unwrap_model(self.model).generate(asrs_batch, self.accelerator)
                 generated = sum([[bs, aspn, rs]
                                  for bs, aspn, rs in zip(bs_outputs, asrs_outputs[::2], asrs_outputs[1::2])], [])
 
             generate_corpus.extend(generated)
-
-        corpus_len = len(eval_data.dataset.target_text)
-        reference_dataset = eval_data.dataset
-        generate_corpus = generate_corpus[:corpus_len]
+            if len(generate_corpus) >= corpus_len:
+                # the prepared loader pads the tail batch to even out processes;
+                # everything beyond the reference corpus is duplicated filler
+                del generate_corpus[corpus_len:]
+                break
 
         if self.post_processing == 'paraphrase':
-            for i, gen in enumerate(generate_corpus):
-                if gen.find('[SEP]') >= 0:
-                    gen = gen.split('[SEP]')[1].strip()
-                else:
-                    last = max(gen.rfind('('), gen.rfind(')'))
-                    last = gen.find(' ', last)
-                    gen = gen[last:].strip()
-                generate_corpus[i] = gen
+            generate_corpus = [_strip_paraphrase_source(gen) for gen in generate_corpus]
 
         if self.is_save():
             self.save_generated_text(generate_corpus, is_valid)
@@ -1,3 +1,4 @@
 from textbox.utils.logger import init_logger
-from textbox.utils.utils import get_local_time, ensure_dir, get_model, get_trainer, init_seed, serialized_save, safe_remove
+from textbox.utils.utils import get_local_time, ensure_dir, get_model, get_trainer, init_seed, serialized_save, \
+    safe_remove, load_checkpoint
 from textbox.utils.argument_list import general_parameters, training_parameters, evaluation_parameters
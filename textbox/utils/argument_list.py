@@ -41,7 +41,16 @@ training_parameters = [
     'train_batch_size',
     'grad_clip',
     'weight_decay',  # common parameters
-    'accumulation_steps',  # accelerator
+    'accumulation_steps',
+    'mixed_precision',  # accelerator
+    'num_workers',
+    'prefetch_factor',
+    'pin_memory',
+    'cuda_prefetch',
+    'length_bucket',  # dataloader
+    'tensorsocket',
+    'tensorsocket_port',
+    'tensorsocket_ack_port',  # shared dataloader
     'disable_tqdm',  # tqdm
     'pretrain_task'  # pretraining
 ]
@@ -97,6 +106,7 @@ dataset_parameters = [
     'tgt_len',
     'truncate',  # dataset maximal length
     'tokenize_strategy',  # tokenize strategy
+    'cache_tokenized',  # tokenized ids cache
 ]
 
 efficient_kwargs_dict = {
@@ -1,3 +1,4 @@
+import io
 import os
 import datetime
 import importlib
@@ -90,7 +91,12 @@ def _save(source: Union[dict, list], path_to_save: str, extension_name: str):
             for text in source:
                 fout.write(text + '\n')
     else:
-        torch.save(source, path_to_save)
+        # serialize into memory first and flush with a single write(), instead
+        # of letting torch.save issue many small writes against the file
+        buffer = io.BytesIO()
+        torch.save(source, buffer)
+        with open(path_to_save, 'wb') as fout:
+            fout.write(buffer.getbuffer())
 
 
 def serialized_save(
@@ -170,6 +176,22 @@ def serialized_save(
         os.symlink(path_to_save, path_to_link)
 
 
+def load_checkpoint(path: str) -> dict:
+    r"""Load a checkpoint onto CPU, memory-mapping the file when the installed
+    torch supports it.
+
+    Mapping to CPU keeps the (possibly large) deserialization off the forward
+    device -- load_state_dict copies tensors over afterwards -- and mmap lets
+    the OS page tensors in on demand instead of reading the file up front.
+    Checkpoints carry Config/Timestamp objects, so the weights_only default
+    of torch >= 2.6 must be overridden.
+    """
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    except TypeError:  # torch < 2.0 has no mmap argument
+        return torch.load(path, map_location='cpu')
+
+
 def get_model(model_name):
     r"""Automatically select model class based on model name
 
@@ -215,6 +237,9 @@ def get_trainer(model_name):
 
 def get_tokenizer(config):
     model_name = config['model_name']
+    # let fast tokenizers use their rust thread pool for batch encoding
+    # (data_preparation turns this off again before dataloader workers fork)
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'true')
     if model_name in PLM_MODELS or model_name in RNN_MODELS:
         tokenizer_kwargs = config['tokenizer_kwargs'] or {}
         tokenizer_path = config['tokenizer_path'] or config['model_path']